@@ -1,11 +1,13 @@
 # app.py
 # Streamlit app: Tráfico en vivo – Cajicá (MVP sin Waze) con mini checklist
-import os, json, time
+import os, copy, time, hashlib
 from pathlib import Path
-from typing import Dict, Any
+from typing import Dict, Any, Optional, Tuple
 
+import numpy as np
+import orjson
 import streamlit as st
-from etl_cajica_routes_noshapely import run_once
+from etl_cajica_routes_noshapely import run_once, get_session, lonlat
 
 try:
     from streamlit_folium import st_folium
@@ -16,10 +18,35 @@ except Exception as e:
 
 st.set_page_config(layout="wide", page_title="Cajicá – Tráfico en vivo (MVP sin Waze)")
 
+SEGMENTS_PATH = "cajica_segments.geojson"
+SPEEDS_PATH = "cajica_speeds.geojson"
+# Clics repetidos dentro de esta ventana reutilizan el resultado sin llamar a run_once. El cache de celdas del
+# ETL (ROUTES_TTL_S) ya evita las consultas a la API, pero run_once igual reescribe cajica_speeds.geojson:
+# cambia su mtime e invalida todos los caches del app (lectura, KPIs, bboxes, capa del mapa)
+ETL_CACHE_TTL_S = 60
+
+# Caches: Streamlit re-ejecuta todo el script en cada interacción/auto-refresco
+@st.cache_resource
+def get_http_session():
+    return get_session()
+
+@st.cache_data(max_entries=4)
+def load_geojson(path: str, mtime: float) -> Dict[str, Any]:
+    # mtime forma parte de la llave: se relee solo cuando el ETL reescribe el archivo
+    return orjson.loads(Path(path).read_bytes())
+
+@st.cache_data(show_spinner=True, ttl=ETL_CACHE_TTL_S)
+def run_etl(subsegment_m: float, _max_workers: int, segments_mtime: float) -> Dict[str, Any]:
+    # _max_workers no entra en la llave (prefijo _): solo cambia la concurrencia, no la salida
+    out = run_once(SEGMENTS_PATH, SPEEDS_PATH, subsegment_m=subsegment_m, max_workers=_max_workers,
+                   session=get_http_session())
+    return {**out, "ran_at": time.time()}
+
 # Sidebar – configuración
 st.sidebar.title("Configuración")
 subsegment_m = st.sidebar.slider("Longitud de subtramo (m)", 100, 600, 300, step=50)
-batch_size   = st.sidebar.slider("Tamaño de lote por request", 10, 100, 40, step=10)
+max_workers  = st.sidebar.slider("Consultas simultáneas a la API", 1, 32, 16,
+    help="Cada subtramo es una consulta 1×1; este valor acota cuántas van en paralelo.")
 auto_refresh_sec = st.sidebar.slider("Auto-refresco (segundos)", 0, 300, 60, step=10,
     help="Si es 0, no se auto-refresca.")
 
@@ -35,17 +62,17 @@ with st.expander("✅ Checklist de estado (clic para ver)", expanded=True):
     ok_api = "GOOGLE_MAPS_API_KEY" in st.secrets and bool(st.secrets["GOOGLE_MAPS_API_KEY"])
     st.markdown(f"- {'✅' if ok_api else '❌'} **API Key de Google** (en *Secrets*): " + ("detectada" if ok_api else "NO detectada"))
 
-    seg_path = Path("cajica_segments.geojson")
+    seg_path = Path(SEGMENTS_PATH)
     ok_seg = seg_path.exists()
     st.markdown(f"- {'✅' if ok_seg else '❌'} **Red vial** `cajica_segments.geojson`: " + ("cargada" if ok_seg else "no encontrada"))
 
-    spd_path = Path('cajica_speeds.geojson')
+    spd_path = Path(SPEEDS_PATH)
     ok_spd = spd_path.exists()
     last_update = "—"
     n_feats = 0
     if ok_spd:
         try:
-            gj_tmp = json.load(open(spd_path, 'r', encoding='utf-8'))
+            gj_tmp = load_geojson(SPEEDS_PATH, os.path.getmtime(SPEEDS_PATH))
             feats = gj_tmp.get("features", [])
             n_feats = len(feats)
             times = [f.get("properties",{}).get("updated_at") for f in feats if isinstance(f, dict)]
@@ -65,11 +92,12 @@ col1, col2, col3 = st.columns([1,1,2])
 with col1:
     uploaded = st.file_uploader("Cargar red vial (GeoJSON LineString)", type=["geojson","json"], accept_multiple_files=False, help="Opcional. Si no cargas, se usa 'cajica_segments.geojson' del repo.")
     run_clicked = st.button("Actualizar velocidades", type="primary")
-    if uploaded:
+    # Solo se guarda una vez por archivo subido: reescribirlo en cada rerun cambiaría su mtime e invalidaría el cache del ETL
+    if uploaded and st.session_state.get("uploaded_file_id") != uploaded.file_id:
         try:
-            gj = json.load(uploaded)
-            with open("cajica_segments.geojson", "w", encoding="utf-8") as f:
-                json.dump(gj, f, ensure_ascii=False)
+            gj = orjson.loads(uploaded.getvalue())
+            Path(SEGMENTS_PATH).write_bytes(orjson.dumps(gj))
+            st.session_state["uploaded_file_id"] = uploaded.file_id
             st.success("Red vial cargada y guardada como cajica_segments.geojson")
         except Exception as e:
             st.error(f"Error leyendo GeoJSON: {e}")
@@ -83,7 +111,7 @@ with col3:
     st.markdown("""
 **Cómo funciona**  
 1) Densifica cada tramo en subtramos (~300 m).  
-2) Llama a Google Routes API (matrix) con tráfico.  
+2) Llama a Google Routes API (una consulta por subtramo) con tráfico.  
 3) Calcula velocidad = distancia / duración.  
 4) Publica GeoJSON y lo pinta en el mapa.  
     """)
@@ -91,47 +119,68 @@ with col3:
 # Ejecutar ETL bajo demanda
 if run_clicked:
     try:
-        out = run_once("cajica_segments.geojson", "cajica_speeds.geojson", subsegment_m=subsegment_m, batch_size=batch_size)
-        st.success(f"ETL ejecutado. Subtramos: {len(out.get('features', []))}.")
+        t0 = time.time()
+        out = run_etl(subsegment_m, max_workers, os.path.getmtime(SEGMENTS_PATH))
+        if out["ran_at"] >= t0:
+            st.success(f"ETL ejecutado. Subtramos: {out['n_features']}.")
+        else:  # acierto de cache: run_once no corrió en este clic
+            st.info(f"Resultado del ETL en cache (de hace {t0 - out['ran_at']:.0f} s; se renueva cada "
+                    f"{ETL_CACHE_TTL_S} s). Subtramos: {out['n_features']}.")
     except SystemExit as se:
         st.error("Falta GOOGLE_MAPS_API_KEY en Secrets. Ve a Settings → Secrets para configurarla.")
     except Exception as e:
         st.error(f"Error en ETL: {e}")
 
 # Cargar salida (si existe) o demo
-def load_or_demo() -> Dict[str, Any]:
-    path = "cajica_speeds.geojson"
-    if not os.path.exists(path):
-        demo = {
-            "type": "FeatureCollection",
-            "features": [
-                {
-                    "type": "Feature",
-                    "properties": {"name":"Segmento demo 1","speed_kmh":18.7,"distance_m":350.0,"duration":"67.2s","updated_at":"—","color":"#EF6C00"},
-                    "geometry": {"type":"LineString","coordinates":[[-74.0330,4.9145],[-74.0305,4.9170]]}
-                },
-                {
-                    "type": "Feature",
-                    "properties": {"name":"Segmento demo 2","speed_kmh":46.2,"distance_m":420.0,"duration":"32.7s","updated_at":"—","color":"#2E7D32"},
-                    "geometry": {"type":"LineString","coordinates":[[-74.0285,4.9190],[-74.0255,4.9225]]}
-                }
-            ]
+DEMO = {
+    "type": "FeatureCollection",
+    "features": [
+        {
+            "type": "Feature",
+            "properties": {"name":"Segmento demo 1","speed_kmh":18.7,"distance_m":350.0,"duration":"67.2s","updated_at":"—","color":"#EF6C00"},
+            "geometry": {"type":"LineString","coordinates":[[-74.0330,4.9145],[-74.0305,4.9170]]}
+        },
+        {
+            "type": "Feature",
+            "properties": {"name":"Segmento demo 2","speed_kmh":46.2,"distance_m":420.0,"duration":"32.7s","updated_at":"—","color":"#2E7D32"},
+            "geometry": {"type":"LineString","coordinates":[[-74.0285,4.9190],[-74.0255,4.9225]]}
         }
-        with open(path, "w", encoding="utf-8") as f:
-            json.dump(demo, f, ensure_ascii=False, indent=2)
-        return demo
-    with open(path, "r", encoding="utf-8") as f:
-        return json.load(f)
+    ]
+}
 
-gj = load_or_demo()
+@st.cache_resource
+def seed_demo(path: str) -> bool:
+    # Escribe el demo si aún no hay salida del ETL; corre a lo sumo una vez por proceso
+    if os.path.exists(path):
+        return False
+    Path(path).write_bytes(orjson.dumps(DEMO, option=orjson.OPT_INDENT_2))
+    return True
+
+def load_or_demo() -> Tuple[float, Dict[str, Any]]:
+    # (mtime, geojson). El mtime se lee una sola vez por rerun y es la llave de todos los caches derivados:
+    # si el ETL reemplaza el archivo a mitad del rerun, features, KPIs y bboxes siguen siendo de la misma versión
+    seed_demo(SPEEDS_PATH)
+    try:
+        mtime = os.path.getmtime(SPEEDS_PATH)
+    except OSError:
+        return 0.0, DEMO
+    # Lectura cacheada por (ruta, mtime): solo se re-parsea cuando el ETL reescribe el archivo
+    return mtime, load_geojson(SPEEDS_PATH, mtime)
+
+data_mtime, gj = load_or_demo()
 
 # KPIs
+@st.cache_data(max_entries=4)
+def compute_kpis(data_mtime: float, _features) -> Tuple[int, Optional[float], int, int]:
+    # Una sola pasada sobre las features; el resto son reducciones NumPy. Llave: mtime del archivo de velocidades
+    arr = np.fromiter((v for v in (f.get("properties", {}).get("speed_kmh") for f in _features)
+                       if isinstance(v, (int, float))), dtype=np.float64)
+    n = int(arr.size)
+    avg = float(arr.mean()) if n else None
+    return n, avg, int((arr < 15).sum()), int((arr < 10).sum())
+
 features = gj.get("features", [])
-speeds = [f["properties"].get("speed_kmh") for f in features if isinstance(f.get("properties",{}).get("speed_kmh", None), (int,float))]
-n = len(speeds)
-avg = (sum(speeds)/n) if n else None
-slow = sum(1 for v in speeds if v < 15)
-very_slow = sum(1 for v in speeds if v is not None and v < 10)
+n, avg, slow, very_slow = compute_kpis(data_mtime, features)
 
 k1, k2, k3, k4 = st.columns(4)
 k1.metric("Tramos con dato", n if n else 0)
@@ -140,25 +189,100 @@ k3.metric("< 15 km/h", slow)
 k4.metric("< 10 km/h", very_slow)
 
 # Mapa
-m = folium.Map(location=[4.918, -74.028], zoom_start=13, control_scale=True)
-for feat in features:
-    geom = feat.get("geometry", {})
+MAP_FIELDS = ("name", "speed_kmh", "distance_m", "updated_at")
+MAP_SMOOTH_FACTOR = 1.5  # Leaflet simplifica más las líneas a zoom bajo
+VIEWPORT_PAD = 0.25  # margen (fracción del ancho/alto visible) para no recortar justo en el borde al paneo
+
+def map_feature(i: int, feat) -> Dict[str, Any]:
+    # Propiedades homogéneas: GeoJsonTooltip/Popup exigen que todos los campos existan.
+    # Las coordenadas se usan tal cual: el ETL ya las escribe redondeadas (OUTPUT_DECIMALS)
     props = feat.get("properties", {})
-    if geom.get("type") != "LineString":
-        continue
-    coords = geom.get("coordinates", [])
-    latlngs = [(lat, lon) for lon, lat in coords]  # convertir a (lat, lon)
-    color = props.get("color", "#888888")
-    tooltip = f"{props.get('name','Tramo')} – {props.get('speed_kmh','?')} km/h"
-    popup = f"""
-    <b>{props.get('name','Tramo')}</b><br/>
-    Velocidad: {props.get('speed_kmh','?')} km/h<br/>
-    Longitud: {props.get('distance_m','?')} m<br/>
-    Actualizado: {props.get('updated_at','—')}
-    """
-    folium.PolyLine(latlngs, color=color, weight=6, opacity=0.9, tooltip=tooltip, popup=popup).add_to(m)
-
-st_folium(m, width=1200, height=720)
+    return {"type": "Feature", "id": str(i),
+            "geometry": {"type": "LineString", "coordinates": feat["geometry"]["coordinates"]},
+            "properties": {"name": props.get("name") or "Tramo",
+                           "speed_kmh": props["speed_kmh"] if props.get("speed_kmh") is not None else "?",
+                           "distance_m": props.get("distance_m", "?"),
+                           "updated_at": props.get("updated_at", "—"),
+                           "color": props.get("color", "#888888")}}
+
+@st.cache_resource(max_entries=2)
+def map_features(data_mtime: float, _features) -> list:
+    # Features listas para el mapa, alineadas con _features (None si no es LineString); una vez por versión
+    # del archivo, así un paneo/zoom solo filtra esta lista. Se comparten sin copia entre sesiones: folium no
+    # las modifica porque cada una trae un "id" único (GeoJson.find_identifier solo escribe ids si faltan)
+    return [map_feature(i, f) if f.get("geometry", {}).get("type") == "LineString" else None
+            for i, f in enumerate(_features)]
+
+@st.cache_resource
+def base_map() -> "folium.Map":
+    # Esqueleto del mapa: se construye una vez por proceso y se copia en cada rerun
+    return folium.Map(location=[4.918, -74.028], zoom_start=13, control_scale=True, prefer_canvas=True)
+
+@st.cache_data(max_entries=2)
+def feature_bboxes(data_mtime: float, _features) -> np.ndarray:
+    # (N,4) [min_lon, min_lat, max_lon, max_lat] por feature; se calcula una vez por versión del archivo
+    out = np.full((len(_features), 4), np.nan)
+    for i, f in enumerate(_features):
+        coords = lonlat(f.get("geometry", {}).get("coordinates", []))
+        if len(coords):
+            out[i, :2] = coords.min(axis=0)
+            out[i, 2:] = coords.max(axis=0)
+    return out
+
+def visible_mask(bboxes: np.ndarray, bounds) -> np.ndarray:
+    """Features cuyo bbox intersecta la vista actual (con margen). Sin bounds válidos, todas."""
+    try:
+        south, west = bounds["_southWest"]["lat"], bounds["_southWest"]["lng"]
+        north, east = bounds["_northEast"]["lat"], bounds["_northEast"]["lng"]
+    except (TypeError, KeyError):
+        return np.ones(len(bboxes), dtype=bool)
+    if None in (south, west, north, east):
+        return np.ones(len(bboxes), dtype=bool)
+    pad_lon, pad_lat = (east - west) * VIEWPORT_PAD, (north - south) * VIEWPORT_PAD
+    return ((bboxes[:, 0] <= east + pad_lon) & (bboxes[:, 2] >= west - pad_lon) &
+            (bboxes[:, 1] <= north + pad_lat) & (bboxes[:, 3] >= south - pad_lat))
+
+def build_layer(mapped) -> "folium.FeatureGroup":
+    # Una sola capa GeoJson sobre canvas en vez de un PolyLine (nodo SVG + <script>) por subtramo
+    fg = folium.FeatureGroup(name="Velocidades")
+    data = {"type": "FeatureCollection", "features": mapped}
+    if not data["features"]:
+        return fg
+    folium.GeoJson(
+        data,
+        smooth_factor=MAP_SMOOTH_FACTOR,
+        style_function=lambda f: {"color": f["properties"]["color"], "weight": 6, "opacity": 0.9},
+        tooltip=folium.GeoJsonTooltip(fields=["name", "speed_kmh"], aliases=["Tramo", "km/h"]),
+        popup=folium.GeoJsonPopup(fields=list(MAP_FIELDS),
+                                  aliases=["Tramo", "Velocidad (km/h)", "Longitud (m)", "Actualizado"]),
+    ).add_to(fg)
+    return fg
+
+def session_layer(key: Tuple[float, str], mapped) -> "folium.FeatureGroup":
+    # st_folium muta la capa que recibe (_id, _parent): por eso se cachea por sesión (session_state) y no
+    # con st.cache_resource, que la compartiría entre sesiones concurrentes. Se reconstruye solo si cambia
+    # el archivo de velocidades o el conjunto de features visibles.
+    cached = st.session_state.get("_map_layer")
+    if cached is None or cached[0] != key:
+        cached = (key, build_layer(mapped))
+        st.session_state["_map_layer"] = cached
+    return cached[1]
+
+# Solo se pintan las features dentro de la última vista reportada por el mapa
+# (st_folium con key guarda su valor en session_state antes del rerun que dispara el paneo/zoom)
+# Llave de los datos: el mtime leído junto con las features (la misma de compute_kpis), sin recorrerlas
+map_state = st.session_state.get("mapa") or {}
+bboxes = feature_bboxes(data_mtime, features)
+assert len(bboxes) == len(features), "bboxes de otra versión del archivo de velocidades"
+mask = visible_mask(bboxes, map_state.get("bounds"))
+visible = [mf for mf, keep in zip(map_features(data_mtime, features), mask.tolist()) if keep and mf is not None]
+layer = session_layer((data_mtime, hashlib.md5(np.packbits(mask).tobytes()).hexdigest()), visible)
+
+# st_folium agrega la capa al mapa recibido: se usa una copia para no mutar el esqueleto cacheado.
+# Al cambiar los datos (o la vista) solo se reemplaza la capa en el cliente, sin recargar el mapa.
+m = copy.deepcopy(base_map())
+# Solo se devuelve "bounds": el rerun por paneo/zoom es barato (todo lo demás está cacheado)
+st_folium(m, key="mapa", width=1200, height=720, returned_objects=["bounds"], feature_group_to_add=layer)
 
 # Auto refresh (simple)
 if auto_refresh_sec and auto_refresh_sec > 0:
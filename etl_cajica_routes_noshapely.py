@@ -4,205 +4,515 @@
 ETL de tráfico (sin Shapely) – Compatible con Streamlit Cloud
 -------------------------------------------------------------
 - Lee una red vial GeoJSON (LineString) y la divide en subtramos (~L metros) usando pura trigonometría y distancias WGS84.
-- Para cada subtramo, llama Google Routes API (Distance Matrix v2) con tráfico y calcula speed_kmh.
+- Para cada subtramo, llama Google Routes API (Distance Matrix v2, una consulta 1×1 por par) con tráfico y calcula speed_kmh.
 - Evita dependencia de GEOS/Shapely, por lo que instala fácil en entornos limitados.
+- Incremental: <output>.cache.sqlite guarda los subtramos por geometría y las celdas recientes (TTL) de la API.
 
-Requisitos: requests
+Requisitos: requests, numpy, orjson (opcional: numba, compila la densificación)
 Variables de entorno: GOOGLE_MAPS_API_KEY
 Uso:
-  python etl_cajica_routes_noshapely.py --input cajica_segments.geojson --output cajica_speeds.geojson --subsegment_m 300 --batch_size 40
+  python etl_cajica_routes_noshapely.py --input cajica_segments.geojson --output cajica_speeds.geojson --subsegment_m 300 [--max_workers 16] [--qps 40] [--interval_s 60]
 """
-import os, sys, json, math, argparse, datetime as dt
-from typing import List, Tuple, Dict, Any
+import os, sys, math, time, hashlib, sqlite3, tempfile, argparse, threading, multiprocessing, datetime as dt
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from contextlib import closing
+from email.utils import parsedate_to_datetime
+from functools import lru_cache
+from itertools import repeat
+from pathlib import Path
+from typing import List, Tuple, Dict, Any, Iterator
+import numpy as np
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+try:  # opcional
+    from numba import njit
+except ImportError:
+    njit = None
 
 GOOGLE_ENDPOINT = "https://routes.googleapis.com/distanceMatrix/v2:computeRouteMatrix"
+FIELD_MASK = "originIndex,destinationIndex,status,distanceMeters,duration"  # solo los campos que se leen
 R_EARTH = 6371008.8  # metros
+POOL_SIZE = 32
+MAX_WORKERS = 16  # consultas en vuelo simultáneamente (por defecto)
+RETRY_STATUS = frozenset({429, 500, 502, 503, 504})
+MAX_ATTEMPTS = 5  # intentos por consulta ante 429/5xx
+RETRY_BACKOFF_S = 0.3  # backoff exponencial sin Retry-After: 0.3 s, 0.6 s, 1.2 s, ...
+RETRY_WAIT_MAX_S = 10.0  # tope de espera entre intentos (también para Retry-After)
+DEFAULT_QPS = 40.0  # requests/s hacia la API (1 elemento c/u); ajustar a la cuota de la cuenta (0 = sin límite)
+OUTPUT_DECIMALS = 5  # ~1.1 m en lon/lat; suficiente para pintar subtramos
+DENSIFY_SIMPLIFY_TOL_M = 1.5  # Douglas-Peucker sobre la línea de entrada antes de densificar (vértices colineales)
+WRITE_CHUNK = 1000  # features serializadas por llamada a orjson al escribir la salida
+DENSIFY_PROCESS_MIN = 2000  # líneas nuevas a partir de las cuales la densificación se reparte en procesos (≥2 CPU)
+CACHE_SUFFIX = ".cache.sqlite"  # cache de subtramos y celdas junto a la salida
+ROUTES_TTL_S = 60.0  # edad máxima de una celda reutilizable (frescura del tráfico)
+_SESSION = None
+_PAIRS_CACHE: Dict[str, Tuple[int, float, Tuple]] = {}  # ruta de entrada -> (mtime_ns, subsegment_m, subtramos)
 
-def haversine_m(lon1, lat1, lon2, lat2):
-    # Distancia aproximada en metros entre dos puntos WGS84
-    dlat = math.radians(lat2 - lat1)
-    dlon = math.radians(lon2 - lon1)
-    a = math.sin(dlat/2)**2 + math.cos(math.radians(lat1))*math.cos(math.radians(lat2))*math.sin(dlon/2)**2
-    return 2 * R_EARTH * math.asin(math.sqrt(a))
+def lonlat(coords) -> np.ndarray:
+    """Arreglo (N,2) lon/lat de posiciones GeoJSON; descarta la altitud si viene ([lon, lat, z])."""
+    arr = np.asarray(coords, dtype=np.float64)
+    if arr.size == 0:
+        return np.empty((0, 2))
+    return arr[:, :2]  # sin reshape: con altitud, reshape(-1, 2) mezclaría z con lon/lat
+
+def segment_lengths_m(coords) -> np.ndarray:
+    """Longitudes (m) de cada tramo entre vértices consecutivos de un arreglo (N,2) lon/lat."""
+    arr = lonlat(coords)
+    lon = np.radians(arr[:, 0])
+    lat = np.radians(arr[:, 1])
+    dlat = np.diff(lat)
+    dlon = np.diff(lon)
+    a = np.sin(dlat/2)**2 + np.cos(lat[:-1])*np.cos(lat[1:])*np.sin(dlon/2)**2
+    return 2 * R_EARTH * np.arcsin(np.sqrt(a))
 
 def linestring_length_m(coords: List[Tuple[float,float]]) -> float:
-    return sum(haversine_m(lon1, lat1, lon2, lat2) for (lon1,lat1),(lon2,lat2) in zip(coords[:-1], coords[1:]))
+    return float(segment_lengths_m(coords).sum())
 
-def interpolate_point(lon1, lat1, lon2, lat2, t: float):
-    # Interpolación lineal en lon/lat (válida para distancias cortas típicas urbanas)
-    return (lon1 + (lon2 - lon1)*t, lat1 + (lat2 - lat1)*t)
+_EMPTY_PLAN = (np.empty((0, 2)), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
 
-def densify_linestring(coords: List[Tuple[float,float]], target_len_m: float) -> List[List[Tuple[float,float]]]:
-    """Divide la línea en subtramos de ~target_len_m devolviendo listas de coords por subtramo."""
-    if len(coords) < 2:
-        return []
-    # Precompute segment lengths
-    seglens = [haversine_m(*coords[i], *coords[i+1]) for i in range(len(coords)-1)]
-    total = sum(seglens)
+def _cut_plan_np(arr: np.ndarray, target_len_m: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Puntos de corte (n+1,2) y, por subtramo, el rango [lo, hi) de vértices originales que quedan dentro."""
+    seglens = segment_lengths_m(arr)
+    cum = np.concatenate(([0.0], np.cumsum(seglens)))  # distancia acumulada en cada vértice
+    total = cum[-1]
     if total == 0:
-        return []
-    # Número de subtramos (al menos 1)
+        return _EMPTY_PLAN
+    # Número de subtramos (al menos 1) y distancias de corte equiespaciadas
     n = max(1, int(math.ceil(total / target_len_m)))
-    out = []
-    # Recorremos la línea acumulando distancia y cortando en puntos a distancias iguales
-    cut_positions = [i * total / n for i in range(n)] + [total]
-    # Walk
-    current_seg = 0
-    dist_into_seg = 0.0
-    seg_accum = 0.0
-    cur_pt = coords[0]
-    last_cut_abs = 0.0
-    pts_accum = [cur_pt]
-    for cut_abs in cut_positions[1:]:  # saltamos 0
-        # avanzar hasta alcanzar cut_abs
-        while last_cut_abs < cut_abs and current_seg < len(seglens):
-            seg_len = seglens[current_seg]
-            remaining = seg_len - dist_into_seg
-            needed = cut_abs - last_cut_abs
-            if needed <= remaining + 1e-6:
-                # cortar dentro de este segmento
-                t = (dist_into_seg + needed) / seg_len
-                lon1, lat1 = coords[current_seg]
-                lon2, lat2 = coords[current_seg+1]
-                cut_pt = interpolate_point(lon1, lat1, lon2, lat2, t)
-                pts_accum.append(cut_pt)
-                out.append(pts_accum)
-                # preparar siguiente subtramo
-                pts_accum = [cut_pt]
-                last_cut_abs = cut_abs
-                dist_into_seg += needed
-                if abs(dist_into_seg - seg_len) < 1e-6:
-                    current_seg += 1
-                    dist_into_seg = 0.0
-            else:
-                # saltar al siguiente segmento
-                last_cut_abs += remaining
-                current_seg += 1
-                dist_into_seg = 0.0
-                pts_accum.append(coords[current_seg])
-        # continuar
-    # En caso de redondeos, asegura último punto
-    if pts_accum and pts_accum[-1] != coords[-1]:
-        pts_accum.append(coords[-1])
-    # filtra subtramos degenerados
-    out = [seg for seg in out if len(seg) >= 2]
+    cut_abs = np.linspace(0.0, total, n + 1)
+    # Todos los puntos de corte de una vez: interpolación lineal en lon/lat sobre la distancia acumulada
+    # (válida en distancias urbanas; los tramos de longitud cero no afectan a np.interp)
+    cuts = np.column_stack((np.interp(cut_abs, cum, arr[:, 0]), np.interp(cut_abs, cum, arr[:, 1])))
+    cuts[0], cuts[-1] = arr[0], arr[-1]
+    # Vértices originales estrictamente entre cortes consecutivos
+    lo = np.searchsorted(cum, cut_abs[:-1], side="right")
+    hi = np.searchsorted(cum, cut_abs[1:], side="left")
+    return cuts, lo, hi
+
+def _cut_plan_loop(arr: np.ndarray, target_len_m: float) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Mismo resultado que _cut_plan_np con bucles escalares, pensado para compilarse con numba.njit."""
+    m = arr.shape[0]
+    cum = np.zeros(m)
+    for k in range(m - 1):
+        lat1 = math.radians(arr[k, 1])
+        lat2 = math.radians(arr[k + 1, 1])
+        dlon = math.radians(arr[k + 1, 0]) - math.radians(arr[k, 0])
+        a = math.sin((lat2 - lat1) / 2)**2 + math.cos(lat1)*math.cos(lat2)*math.sin(dlon / 2)**2
+        cum[k + 1] = cum[k] + 2 * R_EARTH * math.asin(math.sqrt(a))
+    total = cum[m - 1]
+    if total == 0:
+        return np.empty((0, 2)), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64)
+    n = max(1, int(math.ceil(total / target_len_m)))
+    step = total / n
+    cuts = np.empty((n + 1, 2))
+    k = 0
+    for i in range(n + 1):
+        c = total if i == n else i * step
+        while k < m - 2 and cum[k + 1] <= c:
+            k += 1
+        seg = cum[k + 1] - cum[k]
+        t = min(max((c - cum[k]) / seg, 0.0), 1.0) if seg > 0 else 0.0
+        cuts[i, 0] = arr[k, 0] + (arr[k + 1, 0] - arr[k, 0]) * t
+        cuts[i, 1] = arr[k, 1] + (arr[k + 1, 1] - arr[k, 1]) * t
+    cuts[0, :] = arr[0]
+    cuts[n, :] = arr[m - 1]
+    lo = np.empty(n, dtype=np.int64)
+    hi = np.empty(n, dtype=np.int64)
+    v = 0
+    w = 0
+    for i in range(n):
+        while v < m and cum[v] <= i * step:
+            v += 1
+        c = total if i + 1 == n else (i + 1) * step
+        while w < m and cum[w] < c:
+            w += 1
+        lo[i] = v
+        hi[i] = w
+    return cuts, lo, hi
+
+# numba es opcional: si está instalado, la densificación corre como código nativo; si no, NumPy
+_cut_plan = njit(cache=True, fastmath=True)(_cut_plan_loop) if njit is not None else _cut_plan_np
+
+def densify_linestring(coords: List[Tuple[float,float]], target_len_m: float) -> List[List[Tuple[float,float]]]:
+    """Divide la línea en subtramos de ~target_len_m devolviendo listas de coords por subtramo.
+
+    Cada subtramo es corte inicial + vértices originales verts[lo:hi] + corte final: puro slicing sobre el
+    plan de cortes (equivalente a substring de Shapely, sin recorrer la línea de nuevo por subtramo).
+    """
+    arr = simplify_linestring(np.ascontiguousarray(lonlat(coords)), DENSIFY_SIMPLIFY_TOL_M)
+    if len(arr) < 2:
+        return []
+    cuts, lo, hi = _cut_plan(arr, float(target_len_m))
+    cuts, verts, lo, hi = cuts.tolist(), arr.tolist(), lo.tolist(), hi.tolist()
+    return [[cuts[i]] + verts[lo[i]:hi[i]] + [cuts[i + 1]] for i in range(len(lo))]
+
+def simplify_linestring(coords, tolerance_m: float) -> np.ndarray:
+    """Douglas-Peucker (tolerancia en metros) sobre una proyección equirectangular local; conserva extremos."""
+    arr = lonlat(coords)
+    if len(arr) < 3 or tolerance_m <= 0:
+        return arr
+    xy = np.radians(arr) * R_EARTH
+    xy[:, 0] *= math.cos(math.radians(arr[:, 1].mean()))
+    keep = np.zeros(len(arr), dtype=bool)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(arr) - 1)]
+    while stack:
+        i, j = stack.pop()
+        if j <= i + 1:
+            continue
+        seg = xy[j] - xy[i]
+        rel = xy[i+1:j] - xy[i]
+        norm = math.hypot(seg[0], seg[1])
+        if norm == 0:
+            d = np.hypot(rel[:, 0], rel[:, 1])
+        else:
+            d = np.abs(seg[0]*rel[:, 1] - seg[1]*rel[:, 0]) / norm
+        k = int(d.argmax())
+        if d[k] > tolerance_m:
+            k += i + 1
+            keep[k] = True
+            stack.append((i, k))
+            stack.append((k, j))
+    return arr[keep]
+
+def output_coords(seg) -> List[List[float]]:
+    # Geometría de salida con precisión recortada (archivo más liviano de parsear/pintar). No se simplifica
+    # otra vez: la línea ya pasó por Douglas-Peucker antes de densificar (una vez por geometría, cacheado)
+    return np.round(np.asarray(seg, dtype=np.float64), OUTPUT_DECIMALS).tolist()
+
+def open_cache(output_path: str) -> sqlite3.Connection:
+    con = sqlite3.connect(output_path + CACHE_SUFFIX)
+    con.execute("CREATE TABLE IF NOT EXISTS densify (geom_hash TEXT, subsegment_m REAL, subsegs BLOB, "
+                "PRIMARY KEY (geom_hash, subsegment_m))")
+    con.execute("CREATE TABLE IF NOT EXISTS routes (key TEXT PRIMARY KEY, ts REAL, cell BLOB)")
+    return con
+
+def densify_cached(con: sqlite3.Connection, lines: List[List[List[float]]],
+                   subsegment_m: float) -> List[List[List[List[float]]]]:
+    """densify_linestring de varias líneas con cache persistente por (hash de geometría, subsegment_m).
+
+    Solo se densifica lo nuevo; si son muchas líneas, en paralelo con un pool de procesos.
+    """
+    # la tolerancia de simplificación entra en la llave: si cambia, los subtramos guardados no se reutilizan
+    hashes = [hashlib.blake2b(orjson.dumps([DENSIFY_SIMPLIFY_TOL_M, c]), digest_size=16).hexdigest() for c in lines]
+    out: List[Any] = [None] * len(lines)
+    for i, h in enumerate(hashes):
+        row = con.execute("SELECT subsegs FROM densify WHERE geom_hash=? AND subsegment_m=?",
+                          (h, subsegment_m)).fetchone()
+        if row:
+            out[i] = orjson.loads(row[0])
+    missing = [i for i, subs in enumerate(out) if subs is None]
+    todo = [lines[i] for i in missing]
+    if len(todo) >= DENSIFY_PROCESS_MIN and (os.cpu_count() or 1) >= 2:
+        # densify_linestring es de nivel de módulo y recibe/devuelve listas: se puede enviar a otros procesos.
+        # "spawn" y no fork: el proceso de Streamlit tiene hilos vivos y un fork con hilos puede bloquear al hijo
+        with ProcessPoolExecutor(mp_context=multiprocessing.get_context("spawn")) as ex:
+            results = list(ex.map(densify_linestring, todo, repeat(subsegment_m), chunksize=64))
+    else:
+        results = [densify_linestring(c, subsegment_m) for c in todo]
+    for i, subs in zip(missing, results):
+        out[i] = subs
+    con.executemany("INSERT OR REPLACE INTO densify VALUES (?,?,?)",
+                    [(hashes[i], subsegment_m, orjson.dumps(out[i])) for i in missing])
     return out
 
-def payload_matrix(origins: List[Tuple[float,float]], destinations: List[Tuple[float,float]]):
-    def pt(lon, lat):
-        return {"waypoint": {"location": {"latLng": {"latitude": lat, "longitude": lon}}}}
+def od_keys(origins: np.ndarray, dests: np.ndarray) -> List[str]:
+    # Llave "lon_o,lat_o|lon_d,lat_d" redondeada a 1e-6° por subtramo
+    return [f"{a:.6f},{b:.6f}|{c:.6f},{d:.6f}" for a, b, c, d in np.hstack((origins, dests)).tolist()]
+
+def load_cells(output_path: str, max_age_s: float) -> Dict[str, Dict[str, Any]]:
+    """Celdas OK guardadas hace menos de max_age_s, por llave od (persisten entre ejecuciones/procesos)."""
+    with closing(open_cache(output_path)) as con:
+        rows = con.execute("SELECT key, cell FROM routes WHERE ts >= ?", (time.time() - max_age_s,))
+        return {k: orjson.loads(c) for k, c in rows}
+
+def store_cells(output_path: str, cells: Dict[str, Dict[str, Any]]) -> None:
+    now = time.time()
+    with closing(open_cache(output_path)) as con, con:
+        con.executemany("INSERT OR REPLACE INTO routes VALUES (?,?,?)",
+                        [(k, now, orjson.dumps(c)) for k, c in cells.items()])
+        con.execute("DELETE FROM routes WHERE ts < ?", (now - ROUTES_TTL_S,))
+
+def waypoints(coords: np.ndarray) -> List[Dict[str, Any]]:
+    """Fragmentos {"waypoint": ...} de un arreglo (N,2) lon/lat; se construyen una vez y se reutilizan en cada consulta."""
+    return [{"waypoint": {"location": {"latLng": {"latitude": lat, "longitude": lon}}}}
+            for lon, lat in coords.tolist()]
+
+def payload_matrix(origins: List[Dict[str, Any]], destinations: List[Dict[str, Any]]):
+    # origins/destinations ya son fragmentos de waypoints(); solo cambia departureTime
     return {
-        "origins": [pt(lon,lat) for (lon,lat) in origins],
-        "destinations": [pt(lon,lat) for (lon,lat) in destinations],
+        "origins": origins,
+        "destinations": destinations,
         "travelMode": "DRIVE",
         "routingPreference": "TRAFFIC_AWARE",
         "departureTime": dt.datetime.now().isoformat()
     }
 
-def request_matrix(session, api_key: str, origins, destinations):
-    headers = {"X-Goog-Api-Key": api_key, "Content-Type": "application/json"}
+class TokenBucket:
+    """Limitador token-bucket compartido entre hilos: acquire() bloquea hasta que haya un token."""
+    def __init__(self, rate_per_sec: float, burst: int = 1):
+        self.rate = float(rate_per_sec)
+        self.capacity = float(max(1, burst))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def get_session() -> requests.Session:
+    """Sesión HTTP compartida con pool de conexiones (reutiliza TCP/TLS entre consultas)."""
+    global _SESSION
+    if _SESSION is None:
+        # El adaptador solo reintenta fallas de conexión (el request no llegó a la API). Los 429/5xx se
+        # reintentan en request_matrix, para que cada intento pase por el limitador de QPS
+        retry = Retry(total=2, connect=2, read=0, status=0, redirect=0, backoff_factor=0.3)
+        adapter = HTTPAdapter(pool_connections=POOL_SIZE, pool_maxsize=POOL_SIZE, max_retries=retry)
+        _SESSION = requests.Session()
+        _SESSION.mount("https://", adapter)
+    return _SESSION
+
+def retry_wait_s(retry_after, attempt: int) -> float:
+    """Espera antes del reintento `attempt` (0, 1, ...): Retry-After si viene, si no backoff exponencial; con tope."""
+    try:
+        wait = float(retry_after)
+    except (TypeError, ValueError):
+        try:  # Retry-After también puede ser una fecha HTTP
+            wait = (parsedate_to_datetime(retry_after) - dt.datetime.now(dt.timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            wait = RETRY_BACKOFF_S * 2 ** attempt
+    return min(max(wait, 0.0), RETRY_WAIT_MAX_S)
+
+@lru_cache(maxsize=4)
+def _headers(api_key: str) -> Dict[str, str]:
+    # Content-Type lo fija requests al usar json=; la máscara recorta la respuesta a lo que se usa
+    return {"X-Goog-Api-Key": api_key, "X-Goog-FieldMask": FIELD_MASK}
+
+def request_matrix(session, api_key: str, origins, destinations,
+                   limiter: TokenBucket = None) -> Iterator[Dict[str, Any]]:
+    """Genera las celdas de la matriz a medida que llegan (respuesta NDJSON leída en streaming, sin decodificar a str)."""
     data = payload_matrix(origins, destinations)
-    r = session.post(GOOGLE_ENDPOINT, headers=headers, data=json.dumps(data), timeout=30)
-    r.raise_for_status()
-    out = []
-    for line in r.text.strip().splitlines():
-        if line.strip():
-            out.append(json.loads(line))
-    return out
+    for attempt in range(MAX_ATTEMPTS):
+        if limiter is not None:
+            limiter.acquire()  # cada intento, también los reintentos, consume un token
+        with session.post(GOOGLE_ENDPOINT, headers=_headers(api_key), json=data, timeout=30, stream=True) as r:
+            if r.status_code in RETRY_STATUS and attempt < MAX_ATTEMPTS - 1:
+                wait = retry_wait_s(r.headers.get("Retry-After"), attempt)
+            else:
+                r.raise_for_status()
+                for line in r.iter_lines():
+                    if line and not line.isspace():  # sin copiar la línea como hacía strip()
+                        yield orjson.loads(line)
+                return
+        time.sleep(wait)
 
-def estimate_speed_kmh(distance_m: float, duration_iso: str) -> float:
+def parse_duration_s(duration_iso: str) -> float:
+    # Duraciones de la API en formato "123.4s"; NaN si no es válida
     if not duration_iso or not duration_iso.endswith("s"):
         return float('nan')
     try:
-        sec = float(duration_iso[:-1])
-        if sec <= 0: return float('nan')
-        return (distance_m / sec) * 3.6
-    except Exception:
+        return float(duration_iso[:-1])
+    except ValueError:
         return float('nan')
 
-def grade_color(v: float) -> str:
-    if math.isnan(v): return "#888888"
-    if v >= 45: return "#2E7D32"
-    if v >= 30: return "#F9A825"
-    if v >= 15: return "#EF6C00"
-    return "#C62828"
+def durations_s(durations_iso: List[str]) -> np.ndarray:
+    """Versión vectorizada de parse_duration_s (NaN donde falta la duración o no tiene la forma "123.4s").
 
-def run_once(input_path: str, output_path: str, subsegment_m: float = 300.0, batch_size: int = 40) -> Dict[str, Any]:
-    api_key = os.getenv("GOOGLE_MAPS_API_KEY")
-    if not api_key:
-        print("ERROR: Debes definir GOOGLE_MAPS_API_KEY en Secrets/entorno.", file=sys.stderr)
-        sys.exit(2)
+    Mismo resultado que parse_duration_s elemento a elemento, también con valores mal formados:
 
-    gj = json.load(open(input_path, "r", encoding="utf-8"))
+    >>> durations_s(["12.5s", "12ss", "s", "", None, "12"]).tolist()
+    [12.5, nan, nan, nan, nan, nan]
+    """
+    arr = np.array([d or "" for d in durations_iso], dtype=str)
+    ok = np.char.endswith(arr, "s")
+    secs = np.full(len(arr), np.nan)
+    try:
+        # rpartition corta exactamente la última "s" (rstrip quitaría todas: "12ss" -> 12.0)
+        secs[ok] = np.char.rpartition(arr[ok], "s")[:, 0].astype(np.float64)
+    except ValueError:  # algún valor mal formado: se resuelve uno a uno
+        return np.array([parse_duration_s(d) for d in durations_iso], dtype=np.float64)
+    return secs
+
+def speeds_kmh(distances_m: np.ndarray, durations_s: np.ndarray) -> np.ndarray:
+    """Velocidad (km/h) de cada subtramo; NaN donde la duración no es positiva."""
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(durations_s > 0, distances_m / durations_s * 3.6, np.nan)
+
+# Umbrales de velocidad (km/h) ordenados y el color de cada intervalo: <15, [15,30), [30,45), >=45
+_THRESH = (15.0, 30.0, 45.0)
+_COLORS = ("#C62828", "#EF6C00", "#F9A825", "#2E7D32")
+_NO_DATA_COLOR = "#888888"
+
+def grade_colors(speeds: np.ndarray) -> np.ndarray:
+    """Color de cada velocidad según el intervalo de _THRESH (np.digitize); gris si no hay dato."""
+    colors = np.array(_COLORS)[np.digitize(speeds, _THRESH)]
+    colors[np.isnan(speeds)] = _NO_DATA_COLOR
+    return colors
+
+def load_pairs(input_path: str, output_path: str, subsegment_m: float) -> Tuple:
+    """Subtramos de la red con sus extremos, llaves od y fragmentos de payload.
+
+    La red es estática entre ciclos: se recalcula solo si cambia el archivo (mtime) o subsegment_m.
+    """
+    path = os.path.abspath(input_path)
+    mtime = os.stat(path).st_mtime_ns
+    hit = _PAIRS_CACHE.get(path)
+    if hit is not None and hit[:2] == (mtime, float(subsegment_m)):
+        return hit[2]
+    gj = orjson.loads(Path(input_path).read_bytes())
     features_in = gj.get("features", [])
-    subsegments = []  # (lonlat_ini, lonlat_fin, coords_subtramo, props_base)
+    # Subtramos en arreglos paralelos (SoA): extremos como (M,2) float64, geometrías y props en listas
+    seg_list: List[List[List[float]]] = []
+    props_list: List[Dict[str, Any]] = []
+    lines: List[List[List[float]]] = []
+    line_props: List[Dict[str, Any]] = []
     for feat in features_in:
         if not isinstance(feat, dict): continue
         geom = feat.get("geometry", {})
-        props = feat.get("properties", {}) or {}
         if geom.get("type") != "LineString": continue
-        coords = geom.get("coordinates", [])
         # espera [ [lon,lat], ... ]
-        subs = densify_linestring(coords, subsegment_m)
-        for seg in subs:
-            subsegments.append((seg[0], seg[-1], seg, props))
-
-    import requests
-    session = requests.Session()
-    features_out = []
-    i = 0
-    while i < len(subsegments):
-        batch = subsegments[i:i+batch_size]
-        origins = [b[0] for b in batch]
-        dests   = [b[1] for b in batch]
+        lines.append(geom.get("coordinates", []))
+        line_props.append(feat.get("properties", {}) or {})
+    with closing(open_cache(output_path)) as con, con:
+        for subs, props in zip(densify_cached(con, lines, subsegment_m), line_props):
+            seg_list.extend(subs)
+            props_list.extend([props] * len(subs))
+    # extremos de todos los subtramos con una sola conversión a NumPy (sin asignar fila por fila)
+    origins = np.array([seg[0] for seg in seg_list], dtype=np.float64).reshape(-1, 2)
+    dests = np.array([seg[-1] for seg in seg_list], dtype=np.float64).reshape(-1, 2)
+    pairs = (seg_list, props_list, origins, dests, od_keys(origins, dests), waypoints(origins), waypoints(dests))
+    _PAIRS_CACHE[path] = (mtime, float(subsegment_m), pairs)
+    return pairs
+
+def run_once(input_path: str, output_path: str, subsegment_m: float = 300.0, *,
+             session: requests.Session = None, max_workers: int = MAX_WORKERS,
+             qps: float = DEFAULT_QPS) -> Dict[str, Any]:
+    api_key = os.getenv("GOOGLE_MAPS_API_KEY")
+    if not api_key:
+        print("ERROR: Debes definir GOOGLE_MAPS_API_KEY en Secrets/entorno.", file=sys.stderr)
+        sys.exit(2)
+
+    seg_list, props_list, origins, dests, keys, origin_frags, dest_frags = \
+        load_pairs(input_path, output_path, subsegment_m)
+    n_subs = len(seg_list)
+
+    # Celdas recientes (< ROUTES_TTL_S, cache en disco) se reutilizan; solo el resto va a la API
+    cached = load_cells(output_path, ROUTES_TTL_S)
+    cells: List[Dict[str, Any]] = [cached.get(k) for k in keys]
+    pending = [i for i, c in enumerate(cells) if c is None]
+    # Subtramos con el mismo par od (llave redondeada a 1e-6°) comparten una sola consulta
+    first: Dict[str, int] = {}
+    for i in pending:
+        first.setdefault(keys[i], i)
+    unique = list(first.values())
+
+    session = session or get_session()
+    workers = max(1, min(max_workers, POOL_SIZE))
+    limiter = TokenBucket(qps, burst=workers) if qps and qps > 0 else None
+
+    def fetch(i):
+        # Una consulta 1×1 por subtramo: la API factura orígenes×destinos y de una matriz B×B solo
+        # se usaba la diagonal. Devuelve la celda (o None) o la excepción, para no abortar el resto
         try:
-            cells = request_matrix(session, api_key, origins, dests)
+            found = list(request_matrix(session, api_key, origin_frags[i:i+1], dest_frags[i:i+1], limiter))
+            return found[0] if found else None
         except Exception as e:
-            # rellena sin dato
-            for _, _, seg, props in batch:
-                dist_m = linestring_length_m(seg)
-                features_out.append({
-                    "type":"Feature",
-                    "geometry":{"type":"LineString","coordinates":seg},
-                    "properties":{**props, "speed_kmh": None, "distance_m": round(dist_m,1),
-                                  "duration": None, "updated_at": dt.datetime.utcnow().isoformat()+"Z",
-                                  "color": grade_color(float('nan'))}
-                })
-            i += batch_size
+            return e
+
+    # El pool de hilos acota los requests en vuelo (no más que las conexiones del pool HTTP)
+    got: Dict[str, Dict[str, Any]] = {}
+    fresh: Dict[str, Dict[str, Any]] = {}
+    with ThreadPoolExecutor(max_workers=workers) as ex:
+        for i, cell in zip(unique, ex.map(fetch, unique)):
+            if isinstance(cell, Exception):
+                continue  # los subtramos con este par quedan sin dato
+            got[keys[i]] = cell
+            if cell and cell.get("status") == "OK":
+                fresh[keys[i]] = cell
+    for i in pending:  # la respuesta se reparte a todos los subtramos con la misma llave
+        cells[i] = got.get(keys[i])
+    store_cells(output_path, fresh)
+
+    # mapear resultados (subtramos sin celda válida se publican sin velocidad)
+    dists = np.empty(n_subs)
+    durs: List[str] = [None] * n_subs
+    for i, (seg, cell) in enumerate(zip(seg_list, cells)):
+        if not cell or cell.get("status")!="OK":
+            dists[i] = linestring_length_m(seg)
             continue
+        durs[i] = cell.get("duration")
+        dists[i] = float(cell["distanceMeters"]) if "distanceMeters" in cell else linestring_length_m(seg)
+    # duraciones, velocidades y colores de todos los subtramos en una sola pasada NumPy
+    speeds = speeds_kmh(dists, durations_s(durs))
+    colors = grade_colors(speeds).tolist()
+    speeds_out = [None if math.isnan(v) else v for v in np.round(speeds, 1).tolist()]
+    dists_out = np.round(dists, 1).tolist()
 
-        # mapear resultados
-        for idx, (_, _, seg, props) in enumerate(batch):
-            cell = next((c for c in cells if c.get("originIndex")==idx and c.get("destinationIndex")==idx), None)
-            if not cell or cell.get("status")!="OK":
-                spd = float('nan'); dur=None
-                dist_m = linestring_length_m(seg)
-            else:
-                dur = cell.get("duration")
-                dist_m = float(cell.get("distanceMeters", linestring_length_m(seg)))
-                spd = estimate_speed_kmh(dist_m, dur)
-            features_out.append({
-                "type":"Feature",
-                "geometry":{"type":"LineString","coordinates":seg},
-                "properties":{**props, "speed_kmh": None if math.isnan(spd) else round(spd,1),
-                              "distance_m": round(dist_m,1), "duration": dur,
-                              "updated_at": dt.datetime.utcnow().isoformat()+"Z",
-                              "color": grade_color(spd)}
-            })
-        i += batch_size
-
-    out = {"type":"FeatureCollection","features":features_out}
-    with open(output_path, "w", encoding="utf-8") as f:
-        json.dump(out, f, ensure_ascii=False)
-    print(f"[OK] Escrito {output_path} con {len(features_out)} subtramos.")
-    return out
+    # Escritura en streaming por bloques: cada WRITE_CHUNK features se serializan con un solo orjson.dumps
+    # (sin mantener la colección completa en memoria). Se escribe a un temporal único en el mismo directorio
+    # y se reemplaza al final: dos ejecuciones simultáneas (dos sesiones del app, o el CLI con --interval_s)
+    # no comparten temporal, y el app solo ve archivos completos.
+    now_iso = dt.datetime.utcnow().isoformat() + "Z"  # una marca de tiempo por ejecución, no por feature
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(output_path) or ".", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(b'{"type":"FeatureCollection","features":[')
+            buf: List[Dict[str, Any]] = [None] * min(WRITE_CHUNK, n_subs)  # preasignado y reutilizado por bloque
+            for start in range(0, n_subs, WRITE_CHUNK):
+                stop = min(start + WRITE_CHUNK, n_subs)
+                for k, i in enumerate(range(start, stop)):
+                    buf[k] = {
+                        "type":"Feature",
+                        "geometry":{"type":"LineString","coordinates":output_coords(seg_list[i])},
+                        "properties":{**props_list[i], "speed_kmh": speeds_out[i],
+                                      "distance_m": dists_out[i], "duration": durs[i],
+                                      "updated_at": now_iso,
+                                      "color": colors[i]}
+                    }
+                chunk = buf if stop - start == len(buf) else buf[:stop - start]
+                if start:
+                    f.write(b",")
+                f.write(orjson.dumps(chunk, option=orjson.OPT_SERIALIZE_NUMPY)[1:-1])  # sin los corchetes de la lista
+            f.write(b"]}")
+        os.chmod(tmp_path, 0o644)  # mkstemp crea con 0600
+        os.replace(tmp_path, output_path)
+    except BaseException:
+        os.unlink(tmp_path)  # sin temporales huérfanos si falla la escritura
+        raise
+    print(f"[OK] Escrito {output_path} con {n_subs} subtramos.")
+    return {"output": output_path, "n_features": n_subs}
 
 if __name__ == "__main__":
     ap = argparse.ArgumentParser()
     ap.add_argument("--input", required=True)
     ap.add_argument("--output", required=True)
     ap.add_argument("--subsegment_m", type=float, default=300.0)
-    ap.add_argument("--batch_size", type=int, default=40)
+    ap.add_argument("--max_workers", type=int, default=MAX_WORKERS, help="consultas en vuelo simultáneamente")
+    ap.add_argument("--qps", type=float, default=DEFAULT_QPS, help="máximo de requests/s a la API (0 = sin límite)")
+    ap.add_argument("--interval_s", type=float, default=0.0, help="repetir cada N segundos (0 = una sola ejecución)")
     args = ap.parse_args()
-    run_once(args.input, args.output, args.subsegment_m, args.batch_size)
+    # Una sola sesión para todos los ciclos: las conexiones HTTPS del pool siguen abiertas entre ejecuciones
+    session = get_session()
+    try:
+        while True:
+            t0 = time.monotonic()
+            run_once(args.input, args.output, args.subsegment_m, session=session,
+                     max_workers=args.max_workers, qps=args.qps)
+            if args.interval_s <= 0:
+                break
+            time.sleep(max(0.0, args.interval_s - (time.monotonic() - t0)))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        session.close()